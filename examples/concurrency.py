@@ -1,6 +1,7 @@
 # Run this with 'mpirun -n 8 python concurrency.py'
 
 import time
+from itertools import chain
 
 from mpi4py import MPI
 
@@ -61,3 +62,32 @@ end = time.time()
 
 print(f"rank={rank} WriteOnceKVStore: time taken to write {N} entries to "
       f"{mydir}/skvlite.sqlite: {end-start} s={s}")
+
+# Instead of having all ranks write to the database concurrently, gather the
+# entries on rank 0 and write them in batches with store_many().
+
+comm = MPI.COMM_WORLD
+pdict = KVStore("skvlite_batched.sqlite", container_dir=mydir)
+
+batch_size = 1024
+batch = []
+
+start = time.time()
+
+for i in range(N):
+    batch.append((rank * N + i, i))
+
+    if len(batch) == batch_size or i == N - 1:
+        data = comm.gather(batch, root=0)
+        if rank == 0:
+            pdict.store_many(chain.from_iterable(data))
+        batch = []
+
+comm.Barrier()
+
+s = sum(pdict[rank * N + i] for i in range(N))
+
+end = time.time()
+
+print(f"rank={rank} KVStore (batched on rank 0): time taken to write {N} entries "
+      f"to {mydir}/skvlite_batched.sqlite: {end-start} s={s}")
@@ -1,12 +1,79 @@
 import os
 import pickle
 import sqlite3
-from typing import Any, Generator, Mapping, Optional, Tuple, TypeVar, cast
+from typing import (Any, Callable, Dict, Generator, Iterable, List, Mapping,
+                    Optional, Tuple, TypeVar, Union, cast)
 
 from pytools.persistent_dict import KeyBuilder
 
+__all__ = [
+    "CollisionWarning",
+    "KVStore",
+    "NoSuchEntryCollisionError",
+    "NoSuchEntryError",
+    "ReadOnlyEntryError",
+    "ReadOnlyKVStore",
+    "WriteOnceKVStore",
+]
+
 K = TypeVar("K")
 V = TypeVar("V")
+T = TypeVar("T")
+
+_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+# SQL statements used on the hot paths. Keeping them as constants ensures they
+# are always served from the connection's prepared statement cache.
+_SQL_SELECT = "SELECT key_blob, value_blob FROM dict WHERE keyhash=?"
+_SQL_SELECT_KEY = "SELECT key_blob FROM dict WHERE keyhash=?"
+_SQL_INSERT = "INSERT INTO dict VALUES (?, ?, ?)"
+_SQL_INSERT_REPLACE = "INSERT OR REPLACE INTO dict VALUES (?, ?, ?)"
+_SQL_INSERT_IGNORE = "INSERT OR IGNORE INTO dict VALUES (?, ?, ?)"
+_SQL_DELETE = "DELETE FROM dict WHERE keyhash=?"
+_SQL_COUNT = "SELECT COUNT(*) FROM dict"
+_SQL_DELETE_RETURNING = "DELETE FROM dict WHERE keyhash=? RETURNING key_blob"
+
+# Default SQLITE_MAX_VARIABLE_NUMBER of SQLite < 3.32
+_MAX_SQL_PARAMETERS = 999
+
+# Keys and values are pickled separately, so that keys() does not need to
+# read and unpickle the (potentially large) values.
+_SQL_CREATE_TABLE = (
+    "CREATE TABLE IF NOT EXISTS dict "
+    "(keyhash TEXT NOT NULL PRIMARY KEY, key_blob BLOB NOT NULL, "
+    "value_blob BLOB NOT NULL)")
+
+# Version of the table layout, stored in PRAGMA user_version:
+# 0: pickled (key, value) tuple in a single key_value column (skvlite <= 2024.0)
+# 1: separate key_blob and value_blob columns
+_SCHEMA_VERSION = 1
+
+# Entries of a version 0 table that have not been migrated yet are kept in
+# the dict_v0 table.
+_SQL_SELECT_OLD_TABLE = (
+    "SELECT name FROM sqlite_master WHERE type='table' AND name='dict_v0'")
+
+# Number of entries converted per transaction when migrating an old table
+_MIGRATION_BATCH_SIZE = 1000
+
+# Additional data about the dictionary, such as the compression dictionary
+_SQL_CREATE_META_TABLE = (
+    "CREATE TABLE IF NOT EXISTS meta "
+    "(name TEXT NOT NULL PRIMARY KEY, value BLOB NOT NULL)")
+_SQL_SELECT_META = "SELECT value FROM meta WHERE name=?"
+
+# Payloads smaller than this (in bytes) are stored uncompressed
+_MIN_COMPRESSION_SIZE = 96
+
+# https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Minimum number of entries to train a compression dictionary on
+_MIN_TRAINING_SAMPLES = 10
+
+# Compressed entries that are at least this large when decompressed are
+# decompressed in a streaming fashion
+_MIN_STREAMING_SIZE = 1024 * 1024
 
 
 class NoSuchEntryError(KeyError):
@@ -31,9 +98,25 @@ class CollisionWarning(UserWarning):
     pass
 
 
+def _is_busy_error(e: sqlite3.OperationalError) -> bool:
+    """Return *True* if *e* was raised because the database is locked by
+    another connection."""
+    if hasattr(e, "sqlite_errorcode"):
+        return bool(e.sqlite_errorcode == sqlite3.SQLITE_BUSY)
+
+    # sqlite_errorcode is only available in Python >= 3.11
+    return str(e) == "database is locked"
+
+
 class KVStore(Mapping[K, V]):
     def __init__(self, filename: str, container_dir: Optional[str] = None,
-                 enable_wal: bool = False) -> None:
+                 enable_wal: bool = False,
+                 compression: Optional[str] = None,
+                 compression_level: int = 1,
+                 page_size: Optional[int] = None,
+                 mmap_size: int = 256 * 1024 * 1024,
+                 key_builder: Optional[KeyBuilder] = None,
+                 durability: str = "normal") -> None:
         from os.path import join
 
         if container_dir is None:
@@ -54,16 +137,61 @@ class KVStore(Mapping[K, V]):
         os.makedirs(container_dir, exist_ok=True)
         self.filename = join(container_dir, filename + ".sqlite")
 
-        self.key_builder = KeyBuilder()
+        # A custom key builder can, e.g., use a faster hash function by
+        # overriding KeyBuilder.new_hash.
+        self.key_builder = key_builder or KeyBuilder()
+        self._init_hash_key()
+
+        if compression not in (None, "zstd"):
+            raise ValueError(f"unsupported compression '{compression}'")
+
+        self.compression = compression
+        self.compression_level = compression_level
+        self._cctx: Any = None
+        self._dctx: Any = None
+
+        # (data_version, number of entries), see __len__()
+        self._cached_len: Optional[Tuple[int, int]] = None
+
+        # "full": sync to disk on every commit
+        # "normal": sync to disk only at critical moments (default)
+        # "off": never sync, keep the rollback journal in memory and hold an
+        #   exclusive lock on the database. Only suitable for caches that do
+        #   not need to survive a crash and that are not shared between
+        #   processes.
+        if durability not in ("full", "normal", "off"):
+            raise ValueError(f"unsupported durability '{durability}'")
+
+        if durability == "off" and enable_wal:
+            raise ValueError("durability='off' cannot be combined with "
+                             "enable_wal=True")
 
         # isolation_level=None: enable autocommit mode
         # https://www.sqlite.org/lang_transaction.html#implicit_versus_explicit_transactions
-        self.conn = sqlite3.connect(self.filename, isolation_level=None)
+        self.conn = sqlite3.connect(self.filename, isolation_level=None,
+                                    cached_statements=256)
 
-        self._exec_sql(
-            "CREATE TABLE IF NOT EXISTS dict "
-            "(keyhash TEXT NOT NULL PRIMARY KEY, key_value TEXT NOT NULL)"
-        )
+        # Larger pages avoid overflow pages for large values. This only has an
+        # effect on newly created databases (or after vacuum() in non-WAL mode).
+        # https://www.sqlite.org/pragma.html#pragma_page_size
+        if page_size is not None:
+            self._exec_sql(f"PRAGMA page_size = {int(page_size)}")
+
+        self._exec_sql(_SQL_CREATE_TABLE)
+        self._exec_sql(_SQL_CREATE_META_TABLE)
+
+        if compression == "zstd":
+            self._init_zstd()
+
+        if next(self._exec_sql("PRAGMA user_version"))[0] < _SCHEMA_VERSION:
+            self._run_in_transaction(self._upgrade_schema)
+
+        if self._exec_sql(_SQL_SELECT_OLD_TABLE).fetchone():
+            self._migrate_key_value_table()
+
+        # The page size is fixed once the database has been created (it can
+        # only change through VACUUM).
+        self._page_size = self._get_page_size()
 
         # https://www.sqlite.org/wal.html
         if enable_wal:
@@ -73,25 +201,287 @@ class KVStore(Mapping[K, V]):
         # https://www.sqlite.org/pragma.html#pragma_temp_store
         self._exec_sql("PRAGMA temp_store = 'MEMORY'")
 
+        # https://www.sqlite.org/pragma.html#pragma_journal_mode
+        # https://www.sqlite.org/pragma.html#pragma_locking_mode
+        if durability == "off":
+            self._exec_sql("PRAGMA journal_mode = 'MEMORY'")
+            self._exec_sql("PRAGMA locking_mode = 'EXCLUSIVE'")
+
         # https://www.sqlite.org/pragma.html#pragma_synchronous
-        self._exec_sql("PRAGMA synchronous = 'NORMAL'")
+        self._exec_sql(f"PRAGMA synchronous = '{durability.upper()}'")
 
         # 64 MByte of cache
         # https://www.sqlite.org/pragma.html#pragma_cache_size
         self._exec_sql("PRAGMA cache_size = -64000")
 
+        # Memory-mapped I/O for reads (256 MByte by default, 0 disables it)
+        # https://www.sqlite.org/mmap.html
+        self._exec_sql(f"PRAGMA mmap_size = {int(mmap_size)}")
+
+    def _init_hash_key(self) -> None:
+        kb = self.key_builder
+        self._fast_key_updaters: Dict[type, Callable[[Any, Any], None]] = {
+            int: kb.update_for_int,
+            str: kb.update_for_str,
+            bytes: kb.update_for_bytes,
+        }
+
+        # Only use the fast path if it produces the same hashes as the key
+        # builder itself.
+        if (type(kb).rec is not KeyBuilder.rec
+                or type(kb).__call__ is not KeyBuilder.__call__
+                or any(self._hash_key(key) != kb(key) for key in (0, "", b""))):
+            self._fast_key_updaters = {}
+
+    def _hash_key(self, key: Any) -> str:
+        """Return ``self.key_builder(key)``. Common scalar key types are hashed
+        directly, which bypasses the (comparatively slow) generic type
+        dispatch in :meth:`KeyBuilder.rec`."""
+        update = self._fast_key_updaters.get(type(key))
+        if update is None:
+            return self.key_builder(key)
+
+        kb = self.key_builder
+        inner_key_hash = kb.new_hash()
+        update(inner_key_hash, key)
+        key_hash = kb.new_hash()
+        key_hash.update(inner_key_hash.digest())
+        return key_hash.hexdigest()
+
+    def _table_columns(self) -> List[str]:
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(dict)")]
+
+    def _upgrade_schema(self) -> None:
+        if next(self.conn.execute("PRAGMA user_version"))[0] >= _SCHEMA_VERSION:
+            # Another process upgraded the schema in the meantime
+            return
+
+        if "key_value" in self._table_columns():
+            # Table written by skvlite <= 2024.0, which stored the pickled
+            # (key, value) tuple in a single column. Its entries are moved
+            # over by _migrate_key_value_table().
+            self.conn.execute("ALTER TABLE dict RENAME TO dict_v0")
+            self.conn.execute(_SQL_CREATE_TABLE)
+
+        self.conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _migrate_key_value_table(self) -> None:
+        """Move the entries of an old table (see :meth:`_upgrade_schema`)
+        into the current table. This is done in batches, each in a separate
+        transaction, to limit the memory usage and the time the database is
+        locked. It can be interrupted and resumed by another process."""
+        def _migrate_batch() -> bool:
+            if not self.conn.execute(_SQL_SELECT_OLD_TABLE).fetchone():
+                # Another process completed the migration in the meantime
+                return False
+
+            rows = self.conn.execute(
+                "SELECT rowid, keyhash, key_value FROM dict_v0 "
+                "ORDER BY rowid LIMIT ?", (_MIGRATION_BATCH_SIZE,)).fetchall()
+
+            if not rows:
+                self.conn.execute("DROP TABLE dict_v0")
+                return False
+
+            new_rows = []
+            for _, keyhash, key_value in rows:
+                try:
+                    key, value = self._loads(key_value)
+                except Exception:
+                    # Entries that can no longer be unpickled (e.g., because
+                    # their class was removed) are dropped from the cache.
+                    continue
+                new_rows.append((keyhash, self._dumps(key), self._dumps(value)))
+
+            # Entries stored since the upgrade take precedence. Inserting in
+            # rowid order preserves the iteration order.
+            self.conn.executemany(_SQL_INSERT_IGNORE, new_rows)
+            self.conn.execute("DELETE FROM dict_v0 WHERE rowid <= ?",
+                              (rows[-1][0],))
+            return True
+
+        while self._run_in_transaction(_migrate_batch):
+            pass
+
+    def _init_zstd(self) -> None:
+        import zstandard as zstd
+
+        # Trained compression dictionary (see train_dict())
+        dict_data = None
+        row = self._exec_sql(_SQL_SELECT_META, ("zstd_dict",)).fetchone()
+        if row is not None:
+            dict_data = zstd.ZstdCompressionDict(row[0])
+
+        # The compression contexts are reused across all calls, which avoids
+        # the (comparatively expensive) per-call context setup.
+        self._cctx = zstd.ZstdCompressor(level=self.compression_level,
+                                         dict_data=dict_data)
+        self._dctx = zstd.ZstdDecompressor(dict_data=dict_data)
+
+    def _dumps(self, obj: Any) -> bytes:
+        return self._compress(pickle.dumps(obj, protocol=_PICKLE_PROTOCOL))
+
+    def _loads(self, data: bytes) -> Any:
+        if self._dctx is not None and data[:4] == _ZSTD_MAGIC:
+            import zstandard as zstd
+
+            try:
+                # Decompressed size stored in the frame header (-1 if unknown)
+                size = zstd.frame_content_size(data)
+            except zstd.ZstdError:
+                # Corrupt frame header, let _decompress() report the error
+                size = 0
+
+            if not 0 <= size < _MIN_STREAMING_SIZE:
+                # Unpickle large entries (and those of unknown size) directly
+                # from the decompression stream, without materializing the
+                # full decompressed payload first.
+                with self._dctx.stream_reader(data) as reader:
+                    return pickle.load(reader)
+        return pickle.loads(self._decompress(data))
+
+    def _compress(self, data: bytes, cctx: Any = None) -> bytes:
+        if cctx is None:
+            cctx = self._cctx
+
+        # Compression does not pay off for small payloads (e.g., pickled
+        # ints), which are therefore stored uncompressed.
+        if cctx is None or len(data) < _MIN_COMPRESSION_SIZE:
+            return data
+        return cast(bytes, cctx.compress(data))
+
+    def _decompress(self, data: bytes) -> bytes:
+        # Pickled data never starts with the zstd magic number, so compressed
+        # and uncompressed entries can be told apart without an extra tag.
+        if data[:4] != _ZSTD_MAGIC:
+            return data
+        if self._dctx is None:
+            raise ValueError(f"'{self.filename}' contains compressed entries, "
+                             "open it with compression='zstd'")
+        return cast(bytes, self._dctx.decompress(data))
+
+    def train_dict(self, sample_size: int = 1000) -> None:
+        """Train a zstd compression dictionary on (up to) *sample_size*
+        randomly selected entries of the dictionary and recompress all entries
+        with it. The compression dictionary is stored in the database.
+
+        This should not be called while other processes are using the same
+        dictionary, since they would continue to use the previous compression
+        dictionary.
+        """
+        if self.compression != "zstd":
+            raise ValueError("train_dict() requires compression='zstd'")
+
+        import zstandard as zstd
+
+        samples: List[Any] = [
+            self._decompress(row[0]) for row in
+            self._exec_sql("SELECT value_blob FROM dict ORDER BY random() LIMIT ?",
+                           (sample_size,))]
+        if len(samples) < _MIN_TRAINING_SAMPLES:
+            raise ValueError("train_dict() requires at least "
+                             f"{_MIN_TRAINING_SAMPLES} entries, "
+                             f"found {len(samples)}")
+
+        try:
+            dict_data = zstd.train_dictionary(16384, samples)
+        except zstd.ZstdError as e:
+            # e.g., if the samples are too small
+            raise ValueError(f"cannot train a compression dictionary: {e}") from e
+
+        # The contexts of this object are only switched to the new dictionary
+        # once it has been stored, so that a rollback (or a retry of the
+        # transaction) still sees the previous dictionary.
+        cctx = zstd.ZstdCompressor(level=self.compression_level,
+                                   dict_data=dict_data)
+
+        def _recompress() -> None:
+            rows = [(keyhash, self._decompress(k), self._decompress(v))
+                    for keyhash, k, v in self.conn.execute(
+                        "SELECT keyhash, key_blob, value_blob FROM dict")]
+
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                              ("zstd_dict", dict_data.as_bytes()))
+
+            self.conn.executemany(
+                "UPDATE dict SET key_blob=?, value_blob=? WHERE keyhash=?",
+                [(self._compress(k, cctx), self._compress(v, cctx), keyhash)
+                 for keyhash, k, v in rows])
+
+        self._run_in_transaction(_recompress)
+        self._init_zstd()
+
     def _exec_sql(self, *args: Any) -> Any:
         while True:
             try:
                 return self.conn.execute(*args)
             except sqlite3.OperationalError as e:
                 # If the database is busy, retry
-                if (hasattr(e, "sqlite_errorcode")
-                        and not e.sqlite_errorcode == sqlite3.SQLITE_BUSY):
+                if not _is_busy_error(e):
                     raise
             else:
                 break
 
+    def _run_in_transaction(self, func: Callable[[], T]) -> T:
+        """Run *func* inside a transaction, retrying if the database is busy.
+        If a transaction is already active (see :meth:`__enter__`), *func* is
+        run as part of it, inside a savepoint, so that its changes are still
+        undone if it fails."""
+        if self.conn.in_transaction:
+            # https://www.sqlite.org/lang_savepoint.html
+            self.conn.execute("SAVEPOINT skvlite")
+            try:
+                result = func()
+            except Exception as e:
+                self.conn.execute("ROLLBACK TO skvlite")
+                self.conn.execute("RELEASE skvlite")
+                raise e
+            self.conn.execute("RELEASE skvlite")
+            return result
+
+        while True:
+            try:
+                # IMMEDIATE (rather than EXCLUSIVE) takes the write lock
+                # right away, but still lets readers proceed until COMMIT.
+                self.conn.execute("BEGIN IMMEDIATE TRANSACTION")
+
+                try:
+                    result = func()
+                    self.conn.execute("COMMIT")
+                except Exception as e:
+                    self.conn.execute("ROLLBACK")
+                    raise e
+            except sqlite3.OperationalError as e:
+                # If the database is busy, retry
+                if not _is_busy_error(e):
+                    raise
+            else:
+                return result
+
+    def __enter__(self) -> "KVStore[K, V]":
+        """Start a transaction that lasts until the end of the ``with`` block.
+        All modifications made inside the block are committed at once (or
+        rolled back if an exception is raised), which is much faster than
+        committing each of them individually."""
+        if self.conn.in_transaction:
+            raise RuntimeError("nested 'with' blocks on the same KVStore "
+                               "are not supported")
+
+        self._exec_sql("BEGIN IMMEDIATE TRANSACTION")
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self._cached_len = None
+
+        if exc_type is None:
+            self._exec_sql("COMMIT")
+        else:
+            self._exec_sql("ROLLBACK")
+
+            if self.compression == "zstd":
+                # A dictionary trained inside the block was rolled back as well
+                self._init_zstd()
+
     def _collision_check(self, key: K, stored_key: K) -> None:
         if stored_key != key:
             # Key collision, oh well.
@@ -104,27 +494,83 @@ class KVStore(Mapping[K, V]):
             )
 
     def store(self, key: K, value: V, _skip_if_present: bool = False) -> None:
-        keyhash = self.key_builder(key)
-        v = pickle.dumps((key, value))
+        keyhash = self._hash_key(key)
+        self._cached_len = None
 
-        mode = "IGNORE" if _skip_if_present else "REPLACE"
-
-        self._exec_sql(f"INSERT OR {mode} INTO dict VALUES (?, ?)",
-                       (keyhash, v))
+        self._exec_sql(
+            _SQL_INSERT_IGNORE if _skip_if_present else _SQL_INSERT_REPLACE,
+            (keyhash, self._dumps(key), self._dumps(value)))
+
+    def store_many(self, items: Iterable[Tuple[K, V]],
+                   skip_existing: bool = False) -> None:
+        """Store all ``(key, value)`` pairs in *items* in a single transaction.
+        If *skip_existing* is *True*, existing entries are kept (as in
+        :meth:`store_if_not_present`)."""
+        hash_key, dumps = self._hash_key, self._dumps
+        rows = [(hash_key(key), dumps(key), dumps(value)) for key, value in items]
+        self._cached_len = None
+
+        sql = _SQL_INSERT_IGNORE if skip_existing else _SQL_INSERT_REPLACE
+        self._run_in_transaction(lambda: self.conn.executemany(sql, rows))
+
+    def update(self,
+               items: Union[Mapping[K, V], Iterable[Tuple[K, V]]]) -> None:
+        """Store all entries of *items*, which can be a mapping or an iterable
+        of ``(key, value)`` pairs, in a single transaction (see
+        :meth:`store_many`)."""
+        if isinstance(items, Mapping):
+            items = items.items()
+
+        self.store_many(items)
+
+    def fetch_many(self, keys: Iterable[K]) -> List[Tuple[K, V]]:
+        """Return a list of ``(key, value)`` pairs for each of *keys*, in the
+        order of *keys*. Keys that are not in the dictionary are omitted from
+        the result."""
+        hash_key, loads = self._hash_key, self._loads
+        keys = list(keys)
+        keyhashes = [hash_key(key) for key in keys]
+        unique_keyhashes = list(dict.fromkeys(keyhashes))
+
+        rows = {}
+
+        # Look up the keys in chunks, to amortize the per-statement overhead
+        # while staying below SQLite's limit on the number of parameters.
+        for i in range(0, len(unique_keyhashes), _MAX_SQL_PARAMETERS):
+            chunk = unique_keyhashes[i:i + _MAX_SQL_PARAMETERS]
+            c = self._exec_sql("SELECT keyhash, key_blob, value_blob FROM dict "
+                               f"WHERE keyhash IN ({','.join('?' * len(chunk))})",
+                               chunk)
+
+            for keyhash, key_blob, value_blob in c:
+                rows[keyhash] = (key_blob, value_blob)
+
+        result = []
+
+        for key, keyhash in zip(keys, keyhashes):
+            row = rows.get(keyhash)
+            if row is None:
+                continue
+
+            # Each key is checked individually, since keys do not need to be
+            # hashable (or distinct) in the Python sense.
+            self._collision_check(key, loads(row[0]))
+            result.append((key, cast(V, loads(row[1]))))
+
+        return result
 
     def fetch(self, key: K) -> V:
-        keyhash = self.key_builder(key)
+        keyhash = self._hash_key(key)
 
-        c = self._exec_sql("SELECT key_value FROM dict WHERE keyhash=?",
-                           (keyhash,))
+        c = self._exec_sql(_SQL_SELECT, (keyhash,))
         row = c.fetchone()
         if row is None:
             raise NoSuchEntryError(key)
 
-        stored_key, value = pickle.loads(row[0])
+        stored_key = self._loads(row[0])
         self._collision_check(key, stored_key)
 
-        return cast(V, value)
+        return cast(V, self._loads(row[1]))
 
     def __setitem__(self, key: K, value: V) -> None:
         self.store(key, value)
@@ -134,36 +580,33 @@ class KVStore(Mapping[K, V]):
 
     def remove(self, key: K) -> None:
         """Remove the entry associated with *key* from the dictionary."""
-        keyhash = self.key_builder(key)
+        keyhash = self._hash_key(key)
+        self._cached_len = None
+
+        def _remove() -> None:
+            if sqlite3.sqlite_version_info >= (3, 35, 0):
+                # Delete and fetch the entry in a single statement. If the
+                # collision check fails, the deletion is rolled back.
+                rows = self.conn.execute(_SQL_DELETE_RETURNING,
+                                         (keyhash,)).fetchall()
+                if not rows:
+                    raise NoSuchEntryError(key)
+
+                self._collision_check(key, self._loads(rows[0][0]))
+                return
+
+            # This is split into SELECT/DELETE to allow for a collision check
+            c = self.conn.execute(_SQL_SELECT_KEY, (keyhash,))
+            row = c.fetchone()
+            if row is None:
+                raise NoSuchEntryError(key)
+
+            stored_key = self._loads(row[0])
+            self._collision_check(key, stored_key)
 
-        while True:
-            try:
-                self.conn.execute("BEGIN EXCLUSIVE TRANSACTION")
+            self.conn.execute(_SQL_DELETE, (keyhash,))
 
-                try:
-                    # This is split into SELECT/DELETE to allow for a collision check
-                    c = self.conn.execute("SELECT key_value FROM dict "
-                                          "WHERE keyhash=?",
-                                          (keyhash,))
-                    row = c.fetchone()
-                    if row is None:
-                        raise NoSuchEntryError(key)
-
-                    stored_key, _value = pickle.loads(row[0])
-                    self._collision_check(key, stored_key)
-
-                    self.conn.execute("DELETE FROM dict WHERE keyhash=?", (keyhash,))
-                    self.conn.execute("COMMIT")
-                except Exception as e:
-                    self.conn.execute("ROLLBACK")
-                    raise e
-            except sqlite3.OperationalError as e:
-                # If the database is busy, retry
-                if (hasattr(e, "sqlite_errorcode")
-                        and not e.sqlite_errorcode == sqlite3.SQLITE_BUSY):
-                    raise
-            else:
-                break
+        self._run_in_transaction(_remove)
 
     def __delitem__(self, key: K) -> None:
         """Remove the entry associated with *key* from the dictionary."""
@@ -171,34 +614,59 @@ class KVStore(Mapping[K, V]):
 
     def __len__(self) -> int:
         """Return the number of entries in the dictionary."""
-        return cast(int, next(self._exec_sql("SELECT COUNT(*) FROM dict"))[0])
+        # The count is cached until this object modifies the dictionary, or
+        # until the data version changes, which indicates that another
+        # connection has modified the database.
+        # https://www.sqlite.org/pragma.html#pragma_data_version
+        data_version = next(self._exec_sql("PRAGMA data_version"))[0]
+
+        if self._cached_len is None or self._cached_len[0] != data_version:
+            self._cached_len = (
+                data_version, next(self._exec_sql(_SQL_COUNT))[0])
+
+        return self._cached_len[1]
 
     def __iter__(self) -> Generator[K, None, None]:
         """Return an iterator over the keys in the dictionary."""
         return self.keys()
 
+    def _iter_rows(self, sql: str) -> Generator[Tuple[Any, ...], None, None]:
+        # Fetch rows in batches to reduce the per-row overhead of the cursor
+        c = self._exec_sql(sql)
+        c.arraysize = 1024
+
+        while True:
+            rows = c.fetchmany()
+            if not rows:
+                break
+            yield from rows
+
     def keys(self) -> Generator[K, None, None]:  # type: ignore[override]
         """Return an iterator over the keys in the dictionary."""
-        for row in self._exec_sql("SELECT key_value FROM dict ORDER BY rowid"):
-            yield pickle.loads(row[0])[0]
+        loads = self._loads
+        for row in self._iter_rows("SELECT key_blob FROM dict ORDER BY rowid"):
+            yield loads(row[0])
 
     def values(self) -> Generator[V, None, None]:  # type: ignore[override]
         """Return an iterator over the values in the dictionary."""
-        for row in self._exec_sql("SELECT key_value FROM dict ORDER BY rowid"):
-            yield pickle.loads(row[0])[1]
+        loads = self._loads
+        for row in self._iter_rows("SELECT value_blob FROM dict ORDER BY rowid"):
+            yield loads(row[0])
 
     def items(self) -> Generator[Tuple[K, V], None, None]:  # type: ignore[override]
         """Return an iterator over the items in the dictionary."""
-        for row in self._exec_sql("SELECT key_value FROM dict ORDER BY rowid"):
-            yield pickle.loads(row[0])
+        loads = self._loads
+        for row in self._iter_rows(
+                "SELECT key_blob, value_blob FROM dict ORDER BY rowid"):
+            yield loads(row[0]), loads(row[1])
+
+    def _get_page_size(self) -> int:
+        return cast(int, next(self._exec_sql("PRAGMA page_size"))[0])
 
     def nbytes(self) -> int:
         """Return the size of the dictionary in bytes."""
-        return cast(int,
-                    next(self._exec_sql("SELECT page_size * page_count FROM "
-                                        "pragma_page_size(), pragma_page_count()")
-                         )[0]
-                    )
+        return self._page_size * cast(
+            int, next(self._exec_sql("PRAGMA page_count"))[0])
 
     def __repr__(self) -> str:
         """Return a string representation of the dictionary."""
@@ -206,6 +674,7 @@ class KVStore(Mapping[K, V]):
 
     def clear(self) -> None:
         """Remove all entries from the dictionary."""
+        self._cached_len = None
         self._exec_sql("DELETE FROM dict")
 
     def store_if_not_present(self, key: Any, value: Any) -> None:
@@ -213,8 +682,36 @@ class KVStore(Mapping[K, V]):
 
     def vacuum(self) -> None:
         self._exec_sql("VACUUM")
+        self._page_size = self._get_page_size()
+
+        # In WAL mode, VACUUM writes the rebuilt database to the WAL file.
+        # Write it back and truncate the WAL so that the disk space is
+        # actually reclaimed (a no-op without WAL). The busy timeout is
+        # disabled so that this does not wait for readers in other
+        # connections. If it fails, the WAL is written back when the last
+        # connection to the database is closed.
+        # https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+        busy_timeout = next(self._exec_sql("PRAGMA busy_timeout"))[0]
+        self._exec_sql("PRAGMA busy_timeout = 0")
+        try:
+            self._exec_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            self._exec_sql(f"PRAGMA busy_timeout = {busy_timeout}")
 
     def close(self) -> None:
+        try:
+            # Update the query planner statistics if needed
+            # https://www.sqlite.org/pragma.html#pragma_optimize
+            self.conn.execute("PRAGMA optimize")
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError):
+            # This is only maintenance, so skip it if the database is busy
+            # (or the connection has already been closed).
+            pass
+
+        # No explicit WAL checkpoint here, as that would wait for readers in
+        # other connections. SQLite checkpoints and removes the WAL file
+        # when the last connection to the database is closed.
+        # https://www.sqlite.org/wal.html#automatic_checkpoint
         self.conn.close()
 
 
@@ -227,28 +724,59 @@ class ReadOnlyKVStore(KVStore[K, V]):
 
 
 class WriteOnceKVStore(KVStore[K, V]):
-    def store(self, key: K, value: V, _skip_if_present: bool = False) -> None:
-        keyhash = self.key_builder(key)
-        v = pickle.dumps((key, value))
+    def __init__(self, *args: Any, in_mem_cache_size: int = 256,
+                 **kwargs: Any) -> None:
+        """
+        :arg in_mem_cache_size: number of entries kept in an in-memory LRU
+            cache. Since entries cannot be overwritten, the cache does not
+            need to be invalidated by writes.
+        """
+        super().__init__(*args, **kwargs)
+
+        from functools import lru_cache
+
+        self._fetch = (  # type: ignore[method-assign]
+            lru_cache(maxsize=in_mem_cache_size)(self._fetch))
 
+    def store(self, key: K, value: V, _skip_if_present: bool = False) -> None:
+        keyhash = self._hash_key(key)
+        self._cached_len = None
+
+        # An existing entry is left untouched, and no row is inserted
+        c = self._exec_sql(_SQL_INSERT_IGNORE,
+                           (keyhash, self._dumps(key), self._dumps(value)))
+        if c.rowcount == 0 and not _skip_if_present:
+            raise ReadOnlyEntryError("WriteOncePersistentDict, "
+                                     "tried overwriting key")
+
+    def store_many(self, items: Iterable[Tuple[K, V]],
+                   skip_existing: bool = False) -> None:
+        """Store all ``(key, value)`` pairs in *items* in a single transaction.
+        Since entries cannot be overwritten, this raises
+        :exc:`ReadOnlyEntryError` (and stores nothing) if one of the keys is
+        already present, unless *skip_existing* is *True*, in which case
+        existing entries are kept."""
+        hash_key, dumps = self._hash_key, self._dumps
+        rows = [(hash_key(key), dumps(key), dumps(value)) for key, value in items]
+        self._cached_len = None
+
+        sql = _SQL_INSERT_IGNORE if skip_existing else _SQL_INSERT
         try:
-            self._exec_sql("INSERT INTO dict VALUES (?, ?)", (keyhash, v))
+            self._run_in_transaction(lambda: self.conn.executemany(sql, rows))
         except sqlite3.IntegrityError:
-            if not _skip_if_present:
-                raise ReadOnlyEntryError("WriteOncePersistentDict, "
-                                         "tried overwriting key")
+            raise ReadOnlyEntryError("WriteOncePersistentDict, "
+                                     "tried overwriting key")
 
     def _fetch(self, keyhash: str) -> Tuple[K, V]:  # pylint:disable=method-hidden
         # This method is separate from fetch() to allow for LRU caching
-        c = self._exec_sql("SELECT key_value FROM dict WHERE keyhash=?",
-                           (keyhash,))
+        c = self._exec_sql(_SQL_SELECT, (keyhash,))
         row = c.fetchone()
         if row is None:
             raise KeyError
-        return pickle.loads(row[0])  # type: ignore[no-any-return]
+        return self._loads(row[0]), self._loads(row[1])
 
     def fetch(self, key: K) -> V:
-        keyhash = self.key_builder(key)
+        keyhash = self._hash_key(key)
 
         try:
             stored_key, value = self._fetch(keyhash)
@@ -258,5 +786,23 @@ class WriteOnceKVStore(KVStore[K, V]):
             self._collision_check(key, stored_key)
             return value
 
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        super().__exit__(exc_type, exc_value, traceback)
+
+        if exc_type is not None:
+            # Entries stored inside the block were rolled back, but may have
+            # been cached.
+            self._fetch.cache_clear()  # type: ignore[attr-defined]
+
+    def remove(self, key: K) -> None:
+        """Remove the entry associated with *key* from the dictionary."""
+        # lru_cache does not support evicting individual entries
+        self._fetch.cache_clear()  # type: ignore[attr-defined]
+        super().remove(key)
+
+    def clear(self) -> None:
+        super().clear()
+        self._fetch.cache_clear()  # type: ignore[attr-defined]
+
     def __delitem__(self, key: Any) -> None:
         raise AttributeError("Write-once KVStore")
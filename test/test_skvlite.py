@@ -1,11 +1,18 @@
+import os
+import pickle
 import shutil
+import sqlite3
 import sys  # noqa
 import tempfile
+import time
 from dataclasses import dataclass
 from enum import Enum, IntEnum
-from typing import Any
+from random import choices, randrange
+from string import ascii_uppercase
+from typing import Any, Generator, Type
 
 import pytest
+from pytools.persistent_dict import KeyBuilder
 from pytools.tag import Tag, tag_dataclass
 
 from skvlite import KVStore as PersistentDict
@@ -34,318 +41,734 @@ class MyStruct:
     value: int
 
 
-def test_persistent_dict_storage_and_lookup() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: PersistentDict[Any, Any] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+@pytest.fixture(scope="session")
+def tmp_kv_root() -> Generator[str, None, None]:
+    # Prefer a RAM-backed file system (tmpfs) to avoid disk I/O
+    tmpdir = tempfile.mkdtemp(
+        prefix="skvlite-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    yield tmpdir
+    shutil.rmtree(tmpdir)
 
-        from random import randrange
 
-        def rand_str(n: int = 20) -> str:
-            return "".join(chr(65 + randrange(26)) for i in range(n))
+@pytest.fixture
+def tmp_kv_dir(tmp_kv_root: str) -> str:
+    # Each test gets its own (empty) directory, which is removed together
+    # with the session-wide root directory.
+    return tempfile.mkdtemp(dir=tmp_kv_root)
 
-        keys = [(randrange(2000) - 1000, rand_str(), None,
-                 SomeTag(rand_str()),
-                 frozenset({"abc", 123}))
-                for _ in range(20)]
-        values = [randrange(2000) for i in range(20)]
 
-        d = dict(zip(keys, values))
+def test_persistent_dict_storage_and_lookup(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[Any, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
 
-        # {{{ check lookup
+    def rand_str(n: int = 20) -> str:
+        return "".join(choices(ascii_uppercase, k=n))
 
-        for k, v in zip(keys, values):
-            pdict[k] = v
+    keys = [(randrange(2000) - 1000, rand_str(), None,
+             SomeTag(rand_str()),
+             frozenset({"abc", 123}))
+            for _ in range(20)]
+    values = [randrange(2000) for i in range(20)]
 
-        for k, v in d.items():
-            assert d[k] == pdict[k]
-            assert v == pdict[k]
+    d = dict(zip(keys, values))
 
-        # }}}
+    # {{{ check lookup
 
-        # {{{ check updating
+    for k, v in zip(keys, values):
+        pdict[k] = v
 
-        for k, v in zip(keys, values):
-            pdict[k] = v + 1
+    for k, v in d.items():
+        assert d[k] == v == pdict[k]
 
-        for k, v in d.items():
-            assert d[k] + 1 == pdict[k]
-            assert v + 1 == pdict[k]
+    # }}}
 
-        # }}}
+    # {{{ check updating
 
-        # {{{ check store_if_not_present
+    for k, v in zip(keys, values):
+        pdict[k] = v + 1
 
-        for k, _ in zip(keys, values):
-            pdict.store_if_not_present(k, d[k] + 2)
+    for k, v in d.items():
+        assert d[k] + 1 == v + 1 == pdict[k]
 
-        for k, v in d.items():
-            assert d[k] + 1 == pdict[k]
-            assert v + 1 == pdict[k]
+    # }}}
 
-        pdict.store_if_not_present(2001, 2001)
-        assert pdict[2001] == 2001
+    # {{{ check store_if_not_present
 
-        # }}}
+    for k, _ in zip(keys, values):
+        pdict.store_if_not_present(k, d[k] + 2)
 
-        # {{{ check dataclasses
+    for k, v in d.items():
+        assert d[k] + 1 == v + 1 == pdict[k]
 
-        for v in [17, 18]:
-            key = MyStruct("hi", v)
-            pdict[key] = v
+    pdict.store_if_not_present(2001, 2001)
+    assert pdict[2001] == 2001
 
-            # reuse same key, with stored hash
-            assert pdict[key] == v
+    # }}}
 
-        with pytest.raises(KeyError):
-            pdict[MyStruct("hi", 19)]
+    # {{{ check dataclasses
 
-        for v in [17, 18]:
-            # make new key instances
-            assert pdict[MyStruct("hi", v)] == v
+    for v in [17, 18]:
+        key = MyStruct("hi", v)
+        pdict[key] = v
 
-        # }}}
+        # reuse same key, with stored hash
+        assert pdict[key] == v
 
-        # {{{ check enums
+    with pytest.raises(KeyError):
+        pdict[MyStruct("hi", 19)]
 
-        pdict[MyEnum.YES] = 1
-        with pytest.raises(KeyError):
-            pdict[MyEnum.NO]
-        assert pdict[MyEnum.YES] == 1
+    for v in [17, 18]:
+        # make new key instances
+        assert pdict[MyStruct("hi", v)] == v
 
-        pdict[MyIntEnum.YES] = 12
-        with pytest.raises(KeyError):
-            pdict[MyIntEnum.NO]
-        assert pdict[MyIntEnum.YES] == 12
+    # keys do not need to be hashable
+    assert (pdict.fetch_many([MyStruct("hi", 18), MyStruct("hi", 19)])
+            == [(MyStruct("hi", 18), 18)])
 
-        # }}}
+    # }}}
 
-        # check not found
+    # {{{ check enums
 
-        with pytest.raises(KeyError):
-            pdict[3000]
+    pdict[MyEnum.YES] = 1
+    with pytest.raises(KeyError):
+        pdict[MyEnum.NO]
+    assert pdict[MyEnum.YES] == 1
 
-    finally:
-        shutil.rmtree(tmpdir)
+    pdict[MyIntEnum.YES] = 12
+    with pytest.raises(KeyError):
+        pdict[MyIntEnum.NO]
+    assert pdict[MyIntEnum.YES] == 12
 
+    # }}}
 
-def test_persistent_dict_deletion() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: PersistentDict[int, int] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+    # check not found
 
-        pdict[0] = 0
-        del pdict[0]
+    with pytest.raises(KeyError):
+        pdict[3000]
 
-        with pytest.raises(KeyError):
-            pdict[0]
 
-        with pytest.raises(KeyError):
-            del pdict[1]
+def test_hash_key(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[Any, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
 
-    finally:
-        shutil.rmtree(tmpdir)
+    kb = KeyBuilder()
+    for key in [0, 1, -1, 2**64, -2**100, "", "abc", "äöü", b"", b"abc",
+                True, 1.0, (1, "a")]:
+        assert pdict._hash_key(key) == kb(key)
 
+    class MyKeyBuilder(KeyBuilder):
+        def __call__(self, key: Any) -> str:
+            return "prefix-" + super().__call__(key)
 
-def test_persistent_dict_synchronization() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict1: PersistentDict[int, int] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
-        pdict2: PersistentDict[int, int] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+    pdict2: PersistentDict[Any, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       key_builder=MyKeyBuilder())
+    pdict2[1] = 1
+    assert pdict2._hash_key(1) == "prefix-" + kb(1)
+    assert pdict2[1] == 1
 
-        # check lookup
-        pdict1[0] = 1
-        assert pdict2[0] == 1
+    with pytest.raises(KeyError):
+        pdict[1]
 
-        # check updating
-        pdict1[0] = 2
-        assert pdict2[0] == 2
 
-        # check deletion
-        del pdict1[0]
-        with pytest.raises(KeyError):
-            pdict2[0]
+def test_persistent_dict_deletion(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
 
-    finally:
-        shutil.rmtree(tmpdir)
+    pdict[0] = 0
+    del pdict[0]
 
+    with pytest.raises(KeyError):
+        pdict[0]
 
-def test_persistent_dict_clear() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: PersistentDict[int, int] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+    with pytest.raises(KeyError):
+        del pdict[1]
 
-        pdict[0] = 1
-        pdict[0]
-        pdict.clear()
 
-        with pytest.raises(KeyError):
-            pdict[0]
+class CollidingKey:
+    def __init__(self, name: str) -> None:
+        self.name = name
 
-    finally:
-        shutil.rmtree(tmpdir)
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, CollidingKey) and self.name == other.name
 
+    def __hash__(self) -> int:
+        return hash(self.name)
 
-def test_write_once_persistent_dict_storage_and_lookup() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: WriteOncePersistentDict[int, int] = \
-            WriteOncePersistentDict("pytools-test", container_dir=tmpdir)
+    def update_persistent_hash(self, key_hash: Any, key_builder: Any) -> None:
+        # all instances have the same persistent hash
+        key_builder.rec(key_hash, "colliding")
 
-        # check lookup
-        pdict[0] = 1
-        assert pdict[0] == 1
-        # do two lookups to test the cache
-        assert pdict[0] == 1
 
-        # check updating
-        with pytest.raises(ReadOnlyEntryError):
-            pdict[0] = 2
+def test_persistent_dict_collision(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[CollidingKey, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
 
-        # check not found
-        with pytest.raises(KeyError):
-            pdict[1]
+    pdict[CollidingKey("a")] = 1
 
-    finally:
-        shutil.rmtree(tmpdir)
+    with pytest.raises(Exception, match="collision"):
+        pdict[CollidingKey("b")]
 
+    with pytest.raises(Exception, match="collision"):
+        del pdict[CollidingKey("b")]
 
-def test_write_once_persistent_dict_synchronization() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict1: WriteOncePersistentDict[int, int] = \
-            WriteOncePersistentDict("pytools-test", container_dir=tmpdir)
-        pdict2: WriteOncePersistentDict[int, int] = \
-            WriteOncePersistentDict("pytools-test", container_dir=tmpdir)
+    # the colliding deletion did not remove the entry
+    assert pdict[CollidingKey("a")] == 1
 
-        # check lookup
-        pdict1[1] = 0
-        assert pdict2[1] == 0
+    # ... also not inside a with-block
+    with pdict:
+        with pytest.raises(Exception, match="collision"):
+            del pdict[CollidingKey("b")]
+        assert pdict[CollidingKey("a")] == 1
 
-        # check updating
-        with pytest.raises(ReadOnlyEntryError):
-            pdict2[1] = 1
+    assert pdict[CollidingKey("a")] == 1
 
-    finally:
-        shutil.rmtree(tmpdir)
+    del pdict[CollidingKey("a")]
+    assert len(pdict) == 0
 
 
-def test_write_once_persistent_dict_clear() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: WriteOncePersistentDict[int, int] = \
-            WriteOncePersistentDict("pytools-test", container_dir=tmpdir)
+def test_persistent_dict_synchronization(tmp_kv_dir: str) -> None:
+    pdict1: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+    pdict2: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
 
-        pdict[0] = 1
+    # check lookup
+    pdict1[0] = 1
+    assert pdict2[0] == 1
+
+    # check updating
+    pdict1[0] = 2
+    assert pdict2[0] == 2
+
+    # check deletion
+    del pdict1[0]
+    with pytest.raises(KeyError):
+        pdict2[0]
+
+
+@pytest.mark.parametrize("cls", [PersistentDict, WriteOncePersistentDict])
+def test_persistent_dict_clear(cls: Type[PersistentDict[int, int]],
+                               tmp_kv_dir: str) -> None:
+    pdict = cls("pytools-test", container_dir=tmp_kv_dir)
+
+    pdict[0] = 1
+    pdict[0]
+    assert 0 in pdict
+
+    pdict.clear()
+
+    with pytest.raises(KeyError):
         pdict[0]
-        assert 0 in pdict
 
-        pdict.clear()
 
-        with pytest.raises(KeyError):
-            pdict[0]
+def test_write_once_persistent_dict_storage_and_lookup(tmp_kv_dir: str) -> None:
+    pdict: WriteOncePersistentDict[int, int] = \
+        WriteOncePersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    # check lookup
+    pdict[0] = 1
+    assert pdict[0] == 1
+    # do two lookups to test the cache
+    assert pdict[0] == 1
+    assert pdict._fetch.cache_info().hits == 1  # type: ignore[attr-defined]
 
-    finally:
-        shutil.rmtree(tmpdir)
+    # check updating
+    with pytest.raises(ReadOnlyEntryError):
+        pdict[0] = 2
 
+    # check not found
+    with pytest.raises(KeyError):
+        pdict[1]
 
-def test_speed() -> None:
-    import time
 
-    tmpdir = tempfile.mkdtemp()
+def test_write_once_persistent_dict_rollback(tmp_kv_dir: str) -> None:
     pdict: WriteOncePersistentDict[int, int] = \
-        WriteOncePersistentDict("pytools-test", container_dir=tmpdir)
+        WriteOncePersistentDict("pytools-test", container_dir=tmp_kv_dir)
 
-    start = time.time()
-    for i in range(10000):
-        pdict[i] = i
-    end = time.time()
+    # entries cached inside a rolled back transaction
+    with pytest.raises(RuntimeError):
+        with pdict:
+            pdict[5] = 5
+            assert pdict[5] == 5
+            raise RuntimeError
+
+    assert len(pdict) == 0
+    assert 5 not in pdict
+
+    pdict[5] = 6
+    assert pdict[5] == 6
+
+    # entries removed with remove()
+    pdict.remove(5)
+    assert 5 not in pdict
+
+
+def test_write_once_persistent_dict_synchronization(tmp_kv_dir: str) -> None:
+    pdict1: WriteOncePersistentDict[int, int] = \
+        WriteOncePersistentDict("pytools-test", container_dir=tmp_kv_dir)
+    pdict2: WriteOncePersistentDict[int, int] = \
+        WriteOncePersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    # check lookup
+    pdict1[1] = 0
+    assert pdict2[1] == 0
+
+    # check updating
+    with pytest.raises(ReadOnlyEntryError):
+        pdict2[1] = 1
+
+
+def test_speed(tmp_kv_dir: str) -> None:
+    pdict: WriteOncePersistentDict[int, int] = \
+        WriteOncePersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    start = time.perf_counter()
+    with pdict:
+        for i in range(10000):
+            pdict[i] = i
+    end = time.perf_counter()
     print("persistent dict write time: ", end - start)
 
-    start = time.time()
+    start = time.perf_counter()
+    pdict.store_many((i, i) for i in range(10000, 20000))
+    end = time.perf_counter()
+    print("persistent dict store_many time: ", end - start)
+
+    # warm up the page cache
+    for i in range(10000):
+        pdict[i]
+
+    start = time.perf_counter()
     for _ in range(5):
         for i in range(10000):
             pdict[i]
-    end = time.time()
+    end = time.perf_counter()
     print("persistent dict read time: ", end - start)
 
-    shutil.rmtree(tmpdir)
 
+def test_size(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[str, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
 
-def test_size() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: PersistentDict[str, int] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+    pdict.update((str(i) * 7, i) for i in range(10000))
 
-        for i in range(10000):
-            pdict[f"{i}{i}{i}{i}{i}{i}{i}"] = i
+    size = pdict.nbytes()
+    print("sqlite size: ", size / 1024 / 1024, " MByte")
+    assert 0.5 * 1024 * 1024 < size < 2 * 1024 * 1024
 
-        size = pdict.nbytes()
-        print("sqlite size: ", size / 1024 / 1024, " MByte")
-        assert 0.5 * 1024 * 1024 < size < 2 * 1024 * 1024
-    finally:
-        shutil.rmtree(tmpdir)
 
+def test_pragmas(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, bytes] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir, page_size=16384)
 
-def test_len() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: PersistentDict[int, int] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+    pdict[0] = b"x" * 10000
+    assert pdict[0] == b"x" * 10000
+    assert next(pdict.conn.execute("PRAGMA page_size"))[0] == 16384
+    assert pdict.nbytes() % 16384 == 0
+    assert next(pdict.conn.execute("PRAGMA mmap_size"))[0] == 256 * 1024 * 1024
 
-        assert len(pdict) == 0
+    pdict2: PersistentDict[int, bytes] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir, mmap_size=0)
+    assert pdict2[0] == b"x" * 10000
+    assert next(pdict2.conn.execute("PRAGMA mmap_size"))[0] == 0
 
-        for i in range(10000):
-            pdict[i] = i
 
-        assert len(pdict) == 10000
+def test_vacuum(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, bytes] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir, enable_wal=True)
 
-        pdict.clear()
+    pdict.store_many((i, b"x" * 1000) for i in range(1000))
+    size = pdict.nbytes()
+    pdict.conn.execute("PRAGMA wal_checkpoint")
+    file_size = os.path.getsize(pdict.filename)
 
-        assert len(pdict) == 0
-    finally:
-        shutil.rmtree(tmpdir)
+    pdict.clear()
+    pdict.vacuum()
 
+    assert pdict.nbytes() < size
+    assert os.path.getsize(pdict.filename) < file_size
 
-def test_repr() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
-        pdict: PersistentDict[Any, Any] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+    # the WAL is truncated, so that the disk space is actually reclaimed
+    wal_file = pdict.filename + "-wal"
+    assert os.path.getsize(wal_file) == 0
 
-        assert repr(pdict)[:8] == "KVStore("
-    finally:
-        shutil.rmtree(tmpdir)
+    # vacuuming does not wait for readers in other connections: the WAL is
+    # kept until it can be written back
+    pdict2: PersistentDict[int, bytes] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir, enable_wal=True)
+    pdict2.conn.execute("BEGIN")
+    pdict2.conn.execute("SELECT COUNT(*) FROM dict").fetchall()
 
+    pdict.vacuum()
+    assert os.path.getsize(wal_file) > 0
+    assert next(pdict.conn.execute("PRAGMA busy_timeout"))[0] == 5000
 
-def test_keys_values_items() -> None:
-    try:
-        tmpdir = tempfile.mkdtemp()
+    pdict2.conn.execute("COMMIT")
+
+    pdict.vacuum()
+    assert os.path.getsize(wal_file) == 0
+
+
+def test_durability(tmp_kv_dir: str) -> None:
+    for durability, synchronous in [("full", 2), ("normal", 1), ("off", 0)]:
         pdict: PersistentDict[int, int] = \
-            PersistentDict("pytools-test", container_dir=tmpdir)
+            PersistentDict(f"pytools-test-{durability}", container_dir=tmp_kv_dir,
+                           durability=durability)
 
-        for i in range(10000):
-            pdict[i] = i
+        pdict.store_many((i, i) for i in range(100))
+        assert pdict[99] == 99
+        assert next(pdict.conn.execute("PRAGMA synchronous"))[0] == synchronous
+        pdict.close()
+
+    with pytest.raises(ValueError):
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       durability="off", enable_wal=True)
+
+    with pytest.raises(ValueError):
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       durability="none")
+
+
+def test_close(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir, enable_wal=True)
+
+    pdict.store_many((i, i) for i in range(1000))
+
+    pdict2: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir, enable_wal=True)
+    assert pdict2[999] == 999
+
+    # closing does not checkpoint (or vacuum) while other connections are
+    # still open, so it does not wait for their readers
+    pdict2.conn.execute("BEGIN")
+    pdict2.conn.execute("SELECT COUNT(*) FROM dict").fetchall()
+
+    wal_file = pdict.filename + "-wal"
+    file_size = os.path.getsize(pdict.filename)
+    wal_size = os.path.getsize(wal_file)
+    assert wal_size > 0
+
+    pdict.close()
+    assert os.path.getsize(pdict.filename) == file_size
+    assert os.path.getsize(wal_file) == wal_size
+
+    pdict2.conn.execute("COMMIT")
+    pdict2.close()
+    pdict2.close()
+
+    assert not os.path.exists(wal_file) or os.path.getsize(wal_file) == 0
+
+    pdict = PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+    assert len(pdict) == 1000
+
+
+def test_len(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    assert len(pdict) == 0
+
+    pdict.update((i, i) for i in range(10000))
+
+    assert len(pdict) == 10000
+
+    pdict.clear()
+
+    assert len(pdict) == 0
+
+
+def test_len_multiple_connections(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+    pdict2: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    pdict.store_many((i, i) for i in range(100))
+    assert len(pdict) == len(pdict2) == 100
+
+    # modifications through another connection
+    del pdict2[0]
+    assert len(pdict) == len(pdict2) == 99
+
+    pdict2.clear()
+    assert len(pdict) == len(pdict2) == 0
+
+    # rolled back modifications
+    with pytest.raises(RuntimeError):
+        with pdict:
+            pdict[0] = 0
+            assert len(pdict) == 1
+            raise RuntimeError
+
+    assert len(pdict) == len(pdict2) == 0
+
+
+def test_repr(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[Any, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    assert repr(pdict)[:8] == "KVStore("
+
+
+def test_keys_values_items(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    pdict.update((i, i) for i in range(10000))
+
+    keys = list(pdict.keys())
+
+    # This also tests deterministic iteration order
+    assert len(keys) == 10000 == len(set(keys))
+    assert keys == list(range(10000))
+    assert list(pdict.values()) == list(range(10000))
+    assert list(pdict.items()) == list(zip(keys, range(10000)))
+
+    assert keys == list(pdict) == [k for k in pdict]  # noqa: C416
+
+
+def test_store_many(tmp_kv_dir: str) -> None:
+    pdict: PersistentDict[int, int] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    pdict.store_many((i, i) for i in range(1000))
+    assert len(pdict) == 1000
+    assert list(pdict.items()) == [(i, i) for i in range(1000)]
+
+    pdict.store_many([(0, 1)])
+    assert pdict[0] == 1
+
+    pdict.store_many([(0, 2), (1000, 1000)], skip_existing=True)
+    assert pdict[0] == 1
+    assert pdict[1000] == 1000
+    del pdict[1000]
+
+    # check fetch_many (with more keys than fit into a single query)
+    expected = {i: i for i in range(1000)}
+    expected[0] = 1
+    assert (pdict.fetch_many(range(1000, -1000, -1))
+            == [(i, expected[i]) for i in range(999, -1, -1)])
+    assert pdict.fetch_many([]) == []
+    assert pdict.fetch_many([1, 1]) == [(1, 1), (1, 1)]
+
+    # check update (with a mapping)
+    pdict.update({0: 0, 1000: 1000})
+    assert pdict[0] == 0
+    del pdict[1000]
+
+    # check transactions
+    with pdict:
+        for i in range(1000):
+            pdict[i] = i + 1
+        del pdict[0]
+        pdict.store_many([(1000, 1001)])
+
+    assert len(pdict) == 1000
+    assert pdict[1000] == 1001
+
+    with pytest.raises(RuntimeError):
+        with pdict:
+            pdict.clear()
+            raise RuntimeError
+
+    assert len(pdict) == 1000
+
+    # nested transactions are rejected, without affecting the outer one
+    with pdict:
+        pdict[0] = 0
+        with pytest.raises(RuntimeError, match="nested"):
+            with pdict:
+                pass
+
+    assert pdict[0] == 0
+
+    # errors other than SQLITE_BUSY are not retried
+    with pytest.raises(sqlite3.OperationalError):
+        pdict._exec_sql("SELECT * FROM no_such_table")
+
+    wpdict: WriteOncePersistentDict[int, int] = \
+        WriteOncePersistentDict("pytools-test-wo", container_dir=tmp_kv_dir)
+
+    wpdict.store_many((i, i) for i in range(1000))
+    assert wpdict[999] == 999
+
+    with pytest.raises(ReadOnlyEntryError):
+        wpdict.store_many([(1000, 1000), (0, 1)])
+
+    wpdict.store_many([(1001, 1001), (0, 1)], skip_existing=True)
+    assert wpdict[0] == 0
+    assert wpdict[1001] == 1001
+
+    # the failed transaction was rolled back
+    assert 1000 not in wpdict
+
+    # ... also inside a with-block, without affecting the rest of the block
+    with wpdict:
+        wpdict[2000] = 2000
+        with pytest.raises(ReadOnlyEntryError):
+            wpdict.store_many([(2001, 2001), (2002, 2002), (0, 1)])
+
+    assert wpdict[2000] == 2000
+    assert 2001 not in wpdict
+    assert 2002 not in wpdict
+    assert wpdict[0] == 0
+
+
+def test_migrate_key_value_table(tmp_kv_dir: str) -> None:
+    # table layout used by skvlite <= 2024.0
+    conn = sqlite3.connect(os.path.join(tmp_kv_dir, "pytools-test.sqlite"))
+    conn.execute("CREATE TABLE dict "
+                 "(keyhash TEXT NOT NULL PRIMARY KEY, key_value TEXT NOT NULL)")
+    kb = KeyBuilder()
+    conn.executemany("INSERT INTO dict VALUES (?, ?)",
+                     [(kb(i), pickle.dumps((i, str(i)))) for i in range(2500)])
+    # an entry whose class can no longer be imported
+    conn.execute("INSERT INTO dict VALUES (?, ?)",
+                 (kb(2500), b"cno_such_module\nNoSuchClass\n."))
+    conn.commit()
+    conn.close()
+
+    pdict: PersistentDict[int, str] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+
+    assert list(pdict.items()) == [(i, str(i)) for i in range(2500)]
+    pdict[2500] = "2500"
+    assert list(pdict.keys()) == list(range(2501))
+
+    assert next(pdict.conn.execute("PRAGMA user_version"))[0] == 1
+    assert {row[0] for row in pdict.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'")} == {"dict", "meta"}
+
+
+def test_compression(tmp_kv_dir: str) -> None:
+    pytest.importorskip("zstandard")
+
+    pdict: PersistentDict[int, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       compression="zstd")
+
+    for i in range(1000):
+        pdict[i] = {"name": f"entry{i}", "value": i, "data": [i] * 50}
+
+    assert pdict[42] == {"name": "entry42", "value": 42, "data": [42] * 50}
+
+    pdict.train_dict()
+
+    # the compression dictionary is stored inside the database
+    assert os.listdir(tmp_kv_dir) == ["pytools-test.sqlite"]
+
+    for i in range(1000):
+        assert pdict[i]["value"] == i
+
+    pdict[1000] = {"name": "entry1000", "value": 1000, "data": []}
+
+    # small entries are stored uncompressed
+    pdict[1001] = 1001
+    assert pdict[1001] == 1001
+
+    # large entries are decompressed in a streaming fashion, based on their
+    # decompressed size
+    class StreamingSpy:
+        def __init__(self, dctx: Any) -> None:
+            self.dctx = dctx
+            self.nstreamed = 0
+
+        def stream_reader(self, data: bytes) -> Any:
+            self.nstreamed += 1
+            return self.dctx.stream_reader(data)
+
+        def decompress(self, data: bytes) -> bytes:
+            return bytes(self.dctx.decompress(data))
+
+    spy = StreamingSpy(pdict._dctx)
+    pdict._dctx = spy
+
+    large = {"data": os.urandom(2 * 1024 * 1024)}
+    pdict[1002] = large
+    assert pdict[1002] == large
+    assert spy.nstreamed == 1
+
+    compressible = {"data": b"x" * 2 * 1024 * 1024}
+    pdict[1003] = compressible
+    assert len(pdict.conn.execute("SELECT value_blob FROM dict WHERE keyhash=?",
+                                  (pdict._hash_key(1003),)).fetchone()[0]) \
+        < 1024 * 1024
+    assert pdict[1003] == compressible
+    assert spy.nstreamed == 2
+
+    assert pdict[42]["value"] == 42
+    assert spy.nstreamed == 2
+
+    pdict._dctx = spy.dctx
+
+    # corrupt frame headers raise a zstd error
+    import zstandard as zstd
+    pdict.conn.execute("UPDATE dict SET value_blob=? WHERE keyhash=?",
+                       (b"\x28\xb5\x2f\xfd" + b"\xff" * 8, pdict._hash_key(1002)))
+    with pytest.raises(zstd.ZstdError):
+        pdict[1002]
+    pdict[1002] = large
+
+    # reopen with the trained dictionary
+    pdict2: PersistentDict[int, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       compression="zstd")
+    assert pdict2[1000]["name"] == "entry1000"
+    assert list(pdict2.values()) == list(pdict.values())
+
+    # compressed entries cannot be read without compression
+    pdict3: PersistentDict[int, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir)
+    assert pdict3[1001] == 1001
+    with pytest.raises(ValueError):
+        pdict3[42]
+
+    with pytest.raises(ValueError):
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       compression="lzma")
+
+
+def test_train_dict_small(tmp_kv_dir: str) -> None:
+    pytest.importorskip("zstandard")
+
+    pdict: PersistentDict[int, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       compression="zstd")
+
+    with pytest.raises(ValueError):
+        pdict.train_dict()
+
+    pdict.update((i, {"value": i, "data": [i] * 50}) for i in range(5))
+    with pytest.raises(ValueError):
+        pdict.train_dict()
+
+    assert pdict[4]["value"] == 4
+
+
+def test_train_dict_rollback(tmp_kv_dir: str) -> None:
+    pytest.importorskip("zstandard")
+
+    pdict: PersistentDict[int, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       compression="zstd")
+
+    pdict.update((i, {"value": i, "data": [i] * 50}) for i in range(1000))
 
-        # This also tests deterministic iteration order
-        assert len(list(pdict.keys())) == 10000 == len(set(pdict.keys()))
-        assert list(pdict.keys()) == list(range(10000))
-        assert list(pdict.values()) == list(range(10000))
-        assert list(pdict.items()) == list(zip(list(pdict.keys()), range(10000)))
+    with pytest.raises(RuntimeError):
+        with pdict:
+            pdict.train_dict()
+            raise RuntimeError
 
-        assert ([k for k in pdict.keys()]  # noqa: C416
-                == list(pdict.keys())
-                == list(pdict)
-                == [k for k in pdict])  # noqa: C416
+    # stored with the previous (untrained) compression dictionary
+    pdict[1000] = {"value": 1000, "data": [1000] * 50}
 
-    finally:
-        shutil.rmtree(tmpdir)
+    pdict2: PersistentDict[int, Any] = \
+        PersistentDict("pytools-test", container_dir=tmp_kv_dir,
+                       compression="zstd")
+    assert pdict2[1000]["value"] == 1000
+    assert pdict2[42]["value"] == 42
 
 
 if __name__ == "__main__":